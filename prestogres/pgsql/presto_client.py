@@ -1,4 +1,3 @@
-import os
 import httplib
 import time
 
@@ -349,8 +348,7 @@ class Client(object):
             columns = q.columns()
             if columns is None:
                 return [], []
-            rows = []
-            map(rows.append, q.results())
+            rows = list(q.results())
             return columns, rows
         finally:
             q.close()
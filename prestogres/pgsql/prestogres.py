@@ -1,8 +1,7 @@
 import plpy
 import presto_client
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 from copy import copy
-import time
 import json
 import re
 
@@ -15,48 +14,49 @@ JSON_TYPE_PATTERN = re.compile("^(?:row|array|map)(?![a-zA-Z])", re.IGNORECASE)
 # See the document about system column names: http://www.postgresql.org/docs/9.3/static/ddl-system-columns.html
 SYSTEM_COLUMN_NAMES = set(["oid", "tableoid", "xmin", "cmin", "xmax", "cmax", "ctid"])
 
+# Maximum number of statements and total length of them in characters (including
+# separators) sent to PostgreSQL by one plpy.execute call of _execute_statements
+STATEMENT_BATCH_SIZE = 500
+STATEMENT_BATCH_CHARS = 1024 * 1024
+
+# Presto types whose PostgreSQL names differ
+PG_TYPE_NAMES = {
+    "varchar": "varchar(255)",  # for old Presto
+    "varbinary": "bytea",
+    "double": "double precision",
+    "tinyint": "integer",
+}
+
 # convert Presto query result field types to PostgreSQL types
 def _pg_result_type(presto_type):
-    if presto_type == "varchar":  # for old Presto
-        return "varchar(255)"
-    elif presto_type == "varbinary":
-        return "bytea"
-    elif presto_type == "double":
-        return "double precision"
+    pg_type = PG_TYPE_NAMES.get(presto_type)
+    if pg_type is not None:
+        return pg_type
     elif JSON_TYPE_PATTERN.match(presto_type):
         return "json"  # TODO record or anyarray???
-    elif presto_type == "tinyint":
-        return "integer"
     else:
         # assuming Presto and PostgreSQL use the same SQL standard name
         return presto_type
 
 # convert Presto table column types to PostgreSQL types
-def _pg_table_type(presto_type):
-    if presto_type == "varchar":  # for old Presto
-        return "varchar(255)"
-    elif presto_type == "varbinary":
-        return "bytea"
-    elif presto_type == "double":
-        return "double precision"
-    elif JSON_TYPE_PATTERN.match(presto_type):
-        return "json"  # TODO record or anyarray???
-    elif presto_type == "tinyint":
-        return "integer"
-    else:
-        # assuming Presto and PostgreSQL use the same SQL standard name
-        return presto_type
+_pg_table_type = _pg_result_type
 
 # queries can include same column name twice but tables can't.
 def _rename_duplicated_column_names(column_names, where):
     renamed = []
     used_names = copy(SYSTEM_COLUMN_NAMES)
+    # number of "_" appended to each name last time. probing restarts from there
+    # because used_names only grows
+    suffix_lengths = {}
     for original_name in column_names:
-        name = original_name
+        suffix_length = suffix_lengths.get(original_name, 0)
+        name = original_name + "_" * suffix_length
         while name in used_names:
+            suffix_length += 1
             name += "_"
+        suffix_lengths[original_name] = suffix_length
         if name != original_name:
-            if name in SYSTEM_COLUMN_NAMES:
+            if original_name in SYSTEM_COLUMN_NAMES:
                 plpy.warning("Column %s is renamed to %s because the name in %s conflicts with PostgreSQL system column names" % \
                         (plpy.quote_ident(original_name), plpy.quote_ident(name), where))
             else:
@@ -68,63 +68,89 @@ def _rename_duplicated_column_names(column_names, where):
 
 # build CREATE TEMPORARY TABLE statement
 def _build_create_temp_table_sql(table_name, column_names, column_types):
-    create_sql = ["create temporary table %s (\n  " % plpy.quote_ident(table_name)]
-
-    first = True
-    for column_name, column_type in zip(column_names, column_types):
-        if first:
-            first = False
-        else:
-            create_sql.append(",\n  ")
-
-        create_sql.append(plpy.quote_ident(column_name))
-        create_sql.append(" ")
-        create_sql.append(column_type)
-
-    create_sql.append("\n)")
-    return ''.join(create_sql)
-
-# build CREATE TABLE statement
-def _build_create_table(schema_name, table_name, column_names, column_types, not_nulls):
-    alter_sql = ["create table %s.%s (\n  " % (plpy.quote_ident(schema_name), plpy.quote_ident(table_name))]
-
-    first = True
-    for column_name, column_type, not_null in zip(column_names, column_types, not_nulls):
-        if first:
-            first = False
-        else:
-            alter_sql.append(",\n  ")
-
-        alter_sql.append("%s %s" % (plpy.quote_ident(column_name), column_type))
-
-        if not_null:
-            alter_sql.append(" not null")
-
-    alter_sql.append("\n)")
-    return ''.join(alter_sql)
-
-def _get_session_time_zone():
-    rows = plpy.execute("show timezone")
-    return rows[0].values()[0]
+    columns = ",\n  ".join("%s %s" % (plpy.quote_ident(column_name), column_type)
+            for column_name, column_type in zip(column_names, column_types))
+    return "create temporary table %s (\n  %s\n)" % (plpy.quote_ident(table_name), columns)
+
+# build CREATE TABLE statement. table name must be quoted and qualified already
+def _build_create_table(quoted_table_name, column_names, column_types, not_nulls):
+    columns = ",\n  ".join(
+            ("%s %s not null" if not_null else "%s %s") % (plpy.quote_ident(column_name), column_type)
+            for column_name, column_type, not_null in zip(column_names, column_types, not_nulls))
+    return "create table %s (\n  %s\n)" % (quoted_table_name, columns)
+
+# prepared plans survive across function calls in a session. reusing them skips
+# parse and plan of fixed queries that run every time.
+_plan_cache = {}
+
+def _prepare(sql, arg_types=()):
+    key = (sql, tuple(arg_types))
+    plan = _plan_cache.get(key)
+    if plan is None:
+        plan = plpy.prepare(sql, list(arg_types))
+        _plan_cache[key] = plan
+    return plan
+
+STATEMENT_SEPARATOR = ";\n"
+
+def _execute_statement_batch(statements):
+    try:
+        plpy.execute(STATEMENT_SEPARATOR.join(statements))
+    except plpy.spiexceptions.QueryCanceled:
+        # cancel request or statement_timeout. don't run the statements again
+        raise
+    except plpy.SPIError:
+        if len(statements) == 1:
+            raise
+        # the failed batch is rolled back. run statements one by one to raise
+        # the error of the statement that actually failed
+        for statement in statements:
+            plpy.execute(statement)
+
+# run statements with less SPI round-trips by joining them into multi-statement strings
+def _execute_statements(statements):
+    batch = []
+    batch_chars = 0
+    for statement in statements:
+        statement_chars = len(statement) + len(STATEMENT_SEPARATOR)
+        if batch and (len(batch) >= STATEMENT_BATCH_SIZE or batch_chars + statement_chars > STATEMENT_BATCH_CHARS):
+            _execute_statement_batch(batch)
+            batch = []
+            batch_chars = 0
+        batch.append(statement)
+        batch_chars += statement_chars
+    if batch:
+        _execute_statement_batch(batch)
+
+# time zone and search_path can be changed by SET at any time. get them by
+# one query instead of caching them
+def _get_session_time_zone_and_search_path_array():
+    rows = plpy.execute(_prepare("select current_setting('timezone') as time_zone," \
+            " ('{' || current_setting('search_path') || '}')::text[] as search_path"))
+    return rows[0]["time_zone"], rows[0]["search_path"]
 
 def _get_session_search_path_array():
-    rows = plpy.execute("select ('{' || current_setting('search_path') || '}')::text[]")
+    rows = plpy.execute(_prepare("select ('{' || current_setting('search_path') || '}')::text[]"))
     return rows[0].values()[0]
 
-NULL_PATTERN = dict({'\0':None})
+NULL_PATTERN = {ord(u'\0'): None}
 
 def remove_null(bs):
-    if isinstance(bs, str):
-        return bs.translate(None, '\0')
-    elif isinstance(bs, unicode):
-        return bs.translate(NULL_PATTERN)
+    # most values don't include \0. checking it first avoids copying the string
+    if isinstance(bs, unicode):
+        if u'\0' in bs:
+            return bs.translate(NULL_PATTERN)
+        return bs
+    elif isinstance(bs, str):
+        if '\0' in bs:
+            return bs.translate(None, '\0')
+        return bs
     else:
         return bs
 
 class QueryAutoClose(object):
     def __init__(self, query):
         self.query = query
-        self.column_names = None
         self.column_types = None
 
     def __del__(self):
@@ -139,10 +165,8 @@ class QueryAutoCloseIterator(object):
         return self
 
     def next(self):
-        row = next(self.gen)
-        for i, v in enumerate(row):
-            row[i] = remove_null(v)
-        return row
+        # map runs the loop in C and builds the converted row in one allocation
+        return map(remove_null, next(self.gen))
 
 class QueryAutoCloseIteratorWithJsonConvert(QueryAutoCloseIterator):
     def __init__(self, gen, query_auto_close, json_columns):
@@ -150,9 +174,7 @@ class QueryAutoCloseIteratorWithJsonConvert(QueryAutoCloseIterator):
         self.json_columns = json_columns
 
     def next(self):
-        row = next(self.gen)
-        for i, v in enumerate(row):
-            row[i] = remove_null(v)
+        row = map(remove_null, next(self.gen))
         for i in self.json_columns:
             row[i] = json.dumps(row[i])
         return row
@@ -165,14 +187,15 @@ session = SessionData()
 
 def start_presto_query(presto_server, presto_user, presto_catalog, presto_schema, function_name, query):
     try:
+        time_zone, search_path = _get_session_time_zone_and_search_path_array()
+
         # preserve search_path if explicitly set
-        search_path = _get_session_search_path_array()
         if search_path != ['$user', 'public'] and len(search_path) > 0:
             # search_path is changed explicitly. use the first schema
             presto_schema = search_path[0]
 
         # start query
-        client = presto_client.Client(server=presto_server, user=presto_user, catalog=presto_catalog, schema=presto_schema, time_zone=_get_session_time_zone())
+        client = presto_client.Client(server=presto_server, user=presto_user, catalog=presto_catalog, schema=presto_schema, time_zone=time_zone)
 
         query = client.query(query)
         session.query_auto_close = QueryAutoClose(query)
@@ -185,7 +208,6 @@ def start_presto_query(presto_server, presto_user, presto_catalog, presto_schema
                 column_types.append(_pg_result_type(column.type))
 
             column_names = _rename_duplicated_column_names(column_names, "a query result")
-            session.query_auto_close.column_names = column_names
             session.query_auto_close.column_types = column_types
 
             # CREATE TABLE for return type of the function
@@ -257,94 +279,103 @@ def setup_system_catalog(presto_server, presto_user, presto_catalog, presto_sche
 
     client = presto_client.Client(server=presto_server, user=presto_user, catalog=presto_catalog, schema='default')
 
-    # get table list
+    # get table list. system schemas are skipped by Presto so that their
+    # columns are not transferred
     sql = "select table_schema, table_name, column_name, is_nullable, data_type" \
-          " from information_schema.columns"
-    columns, rows = client.run(sql)
-    if rows is None:
-        rows = []
-
-    schemas = {}
+          " from information_schema.columns" \
+          " where table_schema not in ('sys', 'information_schema')"
 
-    for row in rows:
-        schema_name = row[0]
-        table_name = row[1]
-        column_name = row[2]
-        is_nullable = row[3]
-        column_type = row[4]
+    # {schema_name: {table_name: [Column]}}
+    schemas = defaultdict(lambda: defaultdict(list))
 
-        if schema_name == "sys" or schema_name == "information_schema":
-            # skip system schemas
-            continue
+    # stream rows instead of fetching all of them into a list first. the
+    # table list can be very large
+    query = client.query(sql)
+    try:
+        for schema_name, table_name, column_name, is_nullable, column_type in query.results():
+            if len(schema_name) < PG_NAMEDATALEN and len(table_name) < PG_NAMEDATALEN and len(column_name) < PG_NAMEDATALEN:
+                schemas[schema_name][table_name].append(Column(column_name, column_type, is_nullable))
+                continue
 
-        if len(schema_name) > PG_NAMEDATALEN - 1:
-            plpy.warning("Schema %s is skipped because its name is longer than %d characters" % \
-                    (plpy.quote_ident(schema_name), PG_NAMEDATALEN - 1))
-            continue
+            # one of the names is too long
+            if len(schema_name) > PG_NAMEDATALEN - 1:
+                plpy.warning("Schema %s is skipped because its name is longer than %d characters" % \
+                        (plpy.quote_ident(schema_name), PG_NAMEDATALEN - 1))
+                continue
 
-        tables = schemas.setdefault(schema_name, {})
+            tables = schemas[schema_name]
 
-        if len(table_name) > PG_NAMEDATALEN - 1:
-            plpy.warning("Table %s.%s is skipped because its name is longer than %d characters" % \
-                    (plpy.quote_ident(schema_name), plpy.quote_ident(table_name), PG_NAMEDATALEN - 1))
-            continue
+            if len(table_name) > PG_NAMEDATALEN - 1:
+                plpy.warning("Table %s.%s is skipped because its name is longer than %d characters" % \
+                        (plpy.quote_ident(schema_name), plpy.quote_ident(table_name), PG_NAMEDATALEN - 1))
+                continue
 
-        columns = tables.setdefault(table_name, [])
+            # the table is created even if all of its columns are skipped
+            tables[table_name]
 
-        if len(column_name) > PG_NAMEDATALEN - 1:
             plpy.warning("Column %s.%s.%s is skipped because its name is longer than %d characters" % \
                     (plpy.quote_ident(schema_name), plpy.quote_ident(table_name), \
                      plpy.quote_ident(column_name), PG_NAMEDATALEN - 1))
-            continue
-
-        columns.append(Column(column_name, column_type, is_nullable))
+    finally:
+        query.close()
 
     # drop all schemas excepting prestogres_catalog, information_schema and pg_%
-    sql = "select n.nspname as schema_name from pg_catalog.pg_namespace n" \
-          " where n.nspname not in ('prestogres_catalog', 'information_schema')" \
-          " and n.nspname not like 'pg_%'"
-    for row in plpy.cursor(sql):
-        plpy.execute("drop schema %s cascade" % plpy.quote_ident(row["schema_name"]))
-
-    # create schema and tables
-    for schema_name, tables in sorted(schemas.items(), key=lambda (k,v): k):
-        try:
-            plpy.execute("create schema %s" % (plpy.quote_ident(schema_name)))
-        except:
-            # ignore error?
-            pass
+    sql = "select n.nspname as schema_name," \
+          " n.nspname in ('prestogres_catalog', 'information_schema') or n.nspname like 'pg_%' as keep" \
+          " from pg_catalog.pg_namespace n"
+    drop_schema_names = []
+    existing_schema_names = set()
+    for row in plpy.execute(_prepare(sql)):
+        schema_name = row["schema_name"]
+        if row["keep"]:
+            existing_schema_names.add(schema_name)
+        else:
+            drop_schema_names.append(schema_name)
+    if drop_schema_names:
+        plpy.execute("drop schema %s cascade" % \
+                ", ".join(plpy.quote_ident(schema_name) for schema_name in drop_schema_names))
 
-        for table_name, columns in sorted(tables.items(), key=lambda (k,v): k):
-            column_names = []
-            column_types = []
-            not_nulls = []
+    statements = []
+    quoted_access_role = plpy.quote_ident(access_role)
+
+    # create schemas and tables
+    for schema_name in sorted(schemas):
+        tables = schemas[schema_name]
+        quoted_schema_name = plpy.quote_ident(schema_name)
+
+        if schema_name not in existing_schema_names:
+            statements.append("create schema %s" % quoted_schema_name)
+
+        for table_name in sorted(tables):
+            columns = tables[table_name]
+            quoted_table_name = "%s.%s" % (quoted_schema_name, plpy.quote_ident(table_name))
 
             if len(columns) >= 1600:
-                plpy.warning("Table %s.%s contains more than 1600 columns. Some columns will be inaccessible" % (plpy.quote_ident(schema_name), plpy.quote_ident(table_name)))
+                plpy.warning("Table %s contains more than 1600 columns. Some columns will be inaccessible" % quoted_table_name)
+                columns = columns[0:1600]
 
-            for column in columns[0:1600]:
-                column_names.append(column.name)
-                column_types.append(_pg_table_type(column.type))
-                not_nulls.append(not column.nullable)
+            column_names = [column.name for column in columns]
+            column_types = [_pg_table_type(column.type) for column in columns]
+            not_nulls = [not column.nullable for column in columns]
 
             # change columns
-            column_names = _rename_duplicated_column_names(column_names,
-                    "%s.%s table" % (plpy.quote_ident(schema_name), plpy.quote_ident(table_name)))
-            create_sql = _build_create_table(schema_name, table_name, column_names, column_types, not_nulls)
-            plpy.execute(create_sql)
+            column_names = _rename_duplicated_column_names(column_names, "%s table" % quoted_table_name)
+            statements.append(_build_create_table(quoted_table_name, column_names, column_types, not_nulls))
 
         # grant access on the schema to the restricted user so that
         # pg_table_is_visible(reloid) used by \d of psql command returns true
-        plpy.execute("grant usage on schema %s to %s" % \
-                (plpy.quote_ident(schema_name), plpy.quote_ident(access_role)))
+        statements.append("grant usage on schema %s to %s" % \
+                (quoted_schema_name, quoted_access_role))
         # this SELECT privilege is unnecessary because queries against those tables
         # won't run on PostgreSQL. causing an exception is good if Prestogres has
         # a bug sending a presto query to PostgreSQL without rewriting.
         # TODO however, it's granted for now because some BI tools might check
         #      has_table_privilege. the best solution is to grant privilege but
         #      actually selecting from those tables causes an exception.
-        plpy.execute("grant select on all tables in schema %s to %s" % \
-                (plpy.quote_ident(schema_name), plpy.quote_ident(access_role)))
+        statements.append("grant select on all tables in schema %s to %s" % \
+                (quoted_schema_name, quoted_access_role))
+
+    _execute_statements(statements)
 
     # fake current_database() to return Presto's catalog name to be compatible with some
     # applications that use db.schema.table syntax to identify a table